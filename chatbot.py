@@ -1,17 +1,28 @@
 from dotenv import load_dotenv
 import streamlit as st
 import os
-import google.generativeai as genai
+import re
 
 # Load environment variables from .env file
 load_dotenv()
 
 api_key = os.getenv("GOOGLE_API_KEY")
+
+
+@st.cache_resource
+def get_model():
+    """Configure Gemini once per server process instead of on every rerun."""
+    # Imported lazily so offline mode never pays for loading the SDK.
+    import google.generativeai as genai
+
+    genai.configure(api_key=api_key)
+    return genai.GenerativeModel('gemini-2.5-flash')
+
+
 use_gemini = False
 if api_key:
     try:
-        genai.configure(api_key=api_key)
-        model = genai.GenerativeModel('gemini-2.5-flash')
+        model = get_model()
         if "chat_session" not in st.session_state:
             st.session_state.chat_session = model.start_chat(history=[])
         use_gemini = True
@@ -22,29 +33,111 @@ else:
     st.info("Running in offline mode — no GOOGLE_API_KEY found. The chatbot will use simple fallback replies.")
 
 
+# Offline intents in priority order: (trigger keywords, reply).
+OFFLINE_INTENTS = (
+    (("joke", "funny", "make me laugh"), "Why did the tomato blush? Because it saw the salad dressing! 😄"),
+    (("story", "bedtime", "tell me a story"), "Once upon a time a little star learned to shine. The end. ✨"),
+    (("riddle", "puzzle"), "What has keys but can't open locks? A keyboard!"),
+)
+OFFLINE_FALLBACK = "I can't reach the helper brain right now, but I'd love to help — try rephrasing your question or check your API key."
+
+_KEYWORD_INTENT = {
+    keyword: index
+    for index, (keywords, _) in enumerate(OFFLINE_INTENTS)
+    for keyword in keywords
+}
+# A single alternation scans the query once instead of once per keyword.
+_KEYWORD_PATTERN = re.compile(
+    "|".join(re.escape(k) for k in sorted(_KEYWORD_INTENT, key=len, reverse=True))
+)
+
+
 def offline_reply(user_query: str) -> str:
     """Return a simple offline reply when the API isn't available."""
-    q = user_query.lower()
-    if any(k in q for k in ["joke", "funny", "make me laugh"]):
-        return "Why did the tomato blush? Because it saw the salad dressing! 😄"
-    if any(k in q for k in ["story", "bedtime", "tell me a story"]):
-        return "Once upon a time a little star learned to shine. The end. ✨"
-    if any(k in q for k in ["riddle", "puzzle"]):
-        return "What has keys but can't open locks? A keyboard!"
-    return "I can't reach the helper brain right now, but I'd love to help — try rephrasing your question or check your API key."
+    return _offline_reply_for(user_query.lower().strip())
+
+
+@st.cache_data(max_entries=256, show_spinner=False)
+def _offline_reply_for(q: str) -> str:
+    """Classify a normalized query; cached so repeated questions skip the scan."""
+    intent = min(
+        (_KEYWORD_INTENT[m.group()] for m in _KEYWORD_PATTERN.finditer(q)),
+        default=None,
+    )
+    if intent is None:
+        return OFFLINE_FALLBACK
+    return OFFLINE_INTENTS[intent][1]
 
 
 def get_gemini_response(user_query):
-    """Send the user's query to Gemini when available, otherwise use offline fallback."""
+    """Stream the reply from Gemini when available, otherwise return the offline fallback.
+
+    Returns a GeminiStream of text chunks for Gemini, or a plain string offline.
+    """
+    if not use_gemini:
+        return offline_reply(user_query)
+    chat_session = st.session_state.chat_session
     try:
-        if use_gemini:
-            response = st.session_state.chat_session.send_message(user_query)
-            return getattr(response, "text", str(response))
-        else:
-            return offline_reply(user_query)
+        stream = chat_session.send_message(user_query, stream=True)
     except Exception as e:
         st.error(f"An error occurred while getting the response: {e}")
+        try:
+            chat_session.history  # raises while a broken reply is still pending
+        except Exception:
+            rewind_chat(chat_session)
         return offline_reply(user_query)
+    return GeminiStream(chat_session, stream)
+
+
+def rewind_chat(chat_session):
+    """Drop the last exchange so a broken reply doesn't block later messages."""
+    try:
+        chat_session.rewind()
+    except IndexError:
+        # No candidate arrived to rewind; start a fresh session next run.
+        st.session_state.pop("chat_session", None)
+
+
+# Finish reasons for a reply that ended normally; anything else (SAFETY,
+# RECITATION, OTHER, ...) leaves the ChatSession history broken.
+CLEAN_FINISH_REASONS = {"FINISH_REASON_UNSPECIFIED", "STOP", "MAX_TOKENS"}
+
+
+class GeminiStream:
+    """Iterate a streamed Gemini reply as text, rewinding the chat if it stops early.
+
+    A ChatSession whose last streamed response was never fully read, or
+    that finished for a reason other than a normal stop, refuses further
+    messages, so such a stream is rolled back. ``complete`` is only True
+    once the whole reply has arrived and finished cleanly.
+    """
+
+    def __init__(self, chat_session, stream):
+        self.chat_session = chat_session
+        self.stream = stream
+        self.complete = False
+
+    def __iter__(self):
+        try:
+            for chunk in self.stream:
+                text = getattr(chunk, "text", "")
+                if text:
+                    yield text
+            self.complete = self._finished_cleanly()
+        except Exception as e:
+            st.error(f"An error occurred while getting the response: {e}")
+        finally:
+            # Also runs on generator close, e.g. when a new message aborts the rerun.
+            if not self.complete:
+                rewind_chat(self.chat_session)
+
+    def _finished_cleanly(self):
+        # stream=True skips the SDK's own finish_reason check, so do it here.
+        candidates = getattr(self.stream, "candidates", None)
+        if not candidates:
+            return False
+        reason = getattr(candidates[0].finish_reason, "name", None)
+        return reason in CLEAN_FINISH_REASONS
 
 
 # --- Streamlit App UI ---
@@ -55,7 +148,7 @@ st.set_page_config(
 )
 
 # --- Carbon-footprint themed CSS ---
-st.markdown("""
+_CSS = """
 <style>
     @import url('https://fonts.googleapis.com/css2?family=Inter:wght@400;600;700&display=swap');
     html, body, [class*="st-"] {
@@ -265,7 +358,26 @@ st.markdown("""
     }
 
 </style>
-""", unsafe_allow_html=True)
+"""
+
+
+def _minify_css(css):
+    """Drop comments and redundant whitespace so each rerun ships a smaller payload."""
+    css = re.sub(r"/\*.*?\*/", "", css, flags=re.S)
+    css = re.sub(r"\s+", " ", css)
+    return re.sub(r"\s*([{};,])\s*", r"\1", css).strip()
+
+
+@st.cache_data
+def _inject_css():
+    """Emit the theme CSS; cache hits replay the element instead of rebuilding it."""
+    # Streamlit drops elements that a rerun does not emit again, so the
+    # stylesheet is replayed every run rather than guarded by session state.
+    st.markdown(_minify_css(_CSS), unsafe_allow_html=True)
+    return True
+
+
+_CSS_RENDERED = _inject_css()
 
 
 st.title("� Carbon Buddy — Chat & Footprint")
@@ -275,19 +387,26 @@ st.write("Chat normally and also see a simple carbon footprint indicator in the
 if 'chat_history' not in st.session_state:
     st.session_state.chat_history = []
 
+# Carbon score: simple deterministic estimator, baseline + 1 per message,
+# kept up to date on append instead of recomputed on every rerun.
+CARBON_SCORE_BASE = 12
+CARBON_SCORE_MAX = 100
+if 'carbon_score' not in st.session_state:
+    st.session_state.carbon_score = min(
+        CARBON_SCORE_BASE + len(st.session_state.chat_history), CARBON_SCORE_MAX
+    )
 
-# --- Sidebar: Carbon footprint tracker widget (simple visual) ---
-def compute_carbon_score(history):
-    # simple deterministic estimator: baseline + messages * scale
-    base = 12
-    per_message = 1
-    score = base + len(history) * per_message
-    # clamp 0-100
-    return min(max(int(score), 0), 100)
 
+def append_message(role, text):
+    """Record a chat message and bump the running carbon score."""
+    st.session_state.chat_history.append({"role": role, "text": text})
+    st.session_state.carbon_score = min(st.session_state.carbon_score + 1, CARBON_SCORE_MAX)
+
+
+# --- Sidebar: Carbon footprint tracker widget (simple visual) ---
 with st.sidebar:
     st.markdown("## Your Carbon Score")
-    current_score = compute_carbon_score(st.session_state.chat_history)
+    current_score = st.session_state.carbon_score
     st.metric("Estimated footprint (kg CO₂/day)", f"{current_score}")
     st.progress(current_score / 100)
     st.markdown("""
@@ -301,22 +420,36 @@ with st.sidebar:
     </div>
     """, unsafe_allow_html=True)
 
+# --- Display Chat History ---
+AVATARS = {"user": "🧑‍💻", "assistant": "🤖"}
+
+for message in st.session_state.chat_history:
+    with st.chat_message(message["role"], avatar=AVATARS[message["role"]]):
+        st.markdown(message["text"])
+
 # --- Chat Input and Submission ---
 user_input = st.chat_input("Ask me about Carbon!")
 
 if user_input:
     # Add user's message to chat history and display it
-    st.session_state.chat_history.append({"role": "user", "text": user_input})
-
-    # Get Gemini's response
-    with st.spinner("Thinking..."):
-        gemini_response = get_gemini_response(user_input)
-        st.session_state.chat_history.append({"role": "assistant", "text": gemini_response})
-
-# --- Display Chat History ---
-for message in st.session_state.chat_history:
-    # Use an emoji for the avatar based on the role
-    avatar = "🧑‍💻" if message["role"] == "user" else "🤖"
-    with st.chat_message(message["role"], avatar=avatar):
-        st.markdown(message["text"])
-
+    append_message("user", user_input)
+    with st.chat_message("user", avatar=AVATARS["user"]):
+        st.markdown(user_input)
+
+    # Stream Gemini's response as it arrives, then keep the full text
+    with st.chat_message("assistant", avatar=AVATARS["assistant"]):
+        with st.spinner("Thinking..."):
+            gemini_response = get_gemini_response(user_input)
+        if isinstance(gemini_response, str):
+            st.markdown(gemini_response)
+            reply = gemini_response
+        else:
+            streamed = st.write_stream(gemini_response)
+            if not streamed:
+                reply = offline_reply(user_input)
+                st.markdown(reply)
+            else:
+                # A partial reply stays on screen but is not kept as an answer.
+                reply = streamed if gemini_response.complete else None
+    if reply:
+        append_message("assistant", reply)
@@ -9,31 +9,107 @@ Features:
     - Ready for JWT-based authentication hooks.
 """
 
-from datetime import datetime, timedelta, date
-from typing import Dict, Any
+import sqlite3
+from bisect import bisect_right
+from datetime import datetime, timedelta, timezone, date
+from typing import Dict, Any, List, Set, Tuple
 
 from flask import Flask, jsonify, request
+from flask.json.provider import DefaultJSONProvider
 from flask_sqlalchemy import SQLAlchemy
+from sqlalchemy import and_, case, event, func, or_, text
+from sqlalchemy.engine import Engine
+from sqlalchemy.exc import SQLAlchemyError
+
+try:
+    import orjson
+except ImportError:  # optional: fall back to Flask's stdlib json provider
+    orjson = None
+
+
+class OrjsonProvider(DefaultJSONProvider):
+    """Serialize responses with orjson; request parsing stays on the default provider."""
+
+    def _options(self, indent: bool = False) -> int:
+        option = orjson.OPT_NAIVE_UTC | orjson.OPT_NON_STR_KEYS
+        if self.sort_keys:
+            option |= orjson.OPT_SORT_KEYS
+        if indent:
+            option |= orjson.OPT_INDENT_2
+        return option
+
+    def dumps(self, obj: Any, **kwargs: Any) -> str:
+        option = self._options(indent=bool(kwargs.get("indent")))
+        return orjson.dumps(obj, default=self.default, option=option).decode()
+
+    def response(self, *args: Any, **kwargs: Any):
+        obj = self._prepare_response_obj(args, kwargs)
+        pretty = (self.compact is None and self._app.debug) or self.compact is False
+        body = orjson.dumps(obj, default=self.default, option=self._options(indent=pretty))
+        return self._app.response_class(body + b"\n", mimetype=self.mimetype)
 
 
 app = Flask(__name__)
+if orjson is not None:
+    app.json = OrjsonProvider(app)
 app.config["SQLALCHEMY_DATABASE_URI"] = "sqlite:///tokens.db"
 app.config["SQLALCHEMY_TRACK_MODIFICATIONS"] = False
+app.config["SQLALCHEMY_ENGINE_OPTIONS"] = {
+    "pool_size": 20,
+    "max_overflow": 40,
+    "pool_pre_ping": True,
+    "connect_args": {"check_same_thread": False},
+}
 db = SQLAlchemy(app)
 
 TOKENS_PER_KG = 10
 MAX_SAVINGS_PER_DAY = 1000  # kg, anti-cheat guard
+MAX_BULK_EVENTS = 500
+MAX_BACKDATE_DAYS = 7  # oldest day a bulk event may be credited to
+BACKFILL_TOLERANCE = 0.005  # tokens; half of the 2-decimal rounding step
+LEADERBOARD_PAGE_SIZE = 20
+LEADERBOARD_MAX_PAGE_SIZE = 100
+
+ACHIEVEMENT_BADGES = [
+    ("green_starter", 100),
+    ("eco_warrior", 1000),
+    ("zero_carbon_hero", 10000),
+]
+# Parallel tuples sorted by threshold, for bisecting the unlocked prefix.
+_BADGE_NAMES, _BADGE_THRESHOLDS = zip(
+    *sorted(ACHIEVEMENT_BADGES, key=lambda badge: badge[1])
+)
+
+
+@event.listens_for(Engine, "connect")
+def configure_sqlite(dbapi_connection, connection_record) -> None:
+    """WAL lets readers proceed alongside the single writer; NORMAL sync is safe under WAL."""
+    if not isinstance(dbapi_connection, sqlite3.Connection):
+        return
+    cursor = dbapi_connection.cursor()
+    cursor.execute("PRAGMA journal_mode=WAL")
+    cursor.execute("PRAGMA synchronous=NORMAL")
+    cursor.execute("PRAGMA temp_store=MEMORY")
+    cursor.close()
 
 
 class TokenLedger(db.Model):
     __tablename__ = "token_ledger"
+    __table_args__ = (
+        db.Index("ix_ledger_user_date", "user_id", "date"),
+        db.Index("ix_ledger_user_created", "user_id", "created_at"),
+    )
 
     id = db.Column(db.Integer, primary_key=True)
-    user_id = db.Column(db.String(64), nullable=False, index=True)
-    date = db.Column(db.Date, nullable=False, index=True)
+    user_id = db.Column(db.String(64), nullable=False)
+    date = db.Column(db.Date, nullable=False)
     carbon_saved_kg = db.Column(db.Float, nullable=False)
     tokens_earned = db.Column(db.Float, nullable=False)
-    created_at = db.Column(db.DateTime, default=datetime.utcnow, nullable=False)
+    # default= inlines CURRENT_TIMESTAMP into the INSERT for tables created
+    # before server_default existed; server_default covers new tables.
+    created_at = db.Column(
+        db.DateTime, default=func.now(), server_default=func.now(), nullable=False
+    )
 
 
 class LeaderboardEntry(db.Model):
@@ -44,6 +120,10 @@ class LeaderboardEntry(db.Model):
     display_name = db.Column(db.String(120), default="Eco Hero")
     lifetime_tokens = db.Column(db.Float, default=0)
 
+    __table_args__ = (
+        db.Index("ix_leaderboard_lifetime_user", lifetime_tokens.desc(), user_id),
+    )
+
 
 class Achievement(db.Model):
     __tablename__ = "token_achievements"
@@ -51,11 +131,75 @@ class Achievement(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     user_id = db.Column(db.String(64), index=True, nullable=False)
     badge = db.Column(db.String(64), nullable=False)
-    unlocked_on = db.Column(db.DateTime, default=datetime.utcnow)
+    unlocked_on = db.Column(db.DateTime, default=func.now(), server_default=func.now())
+
+
+# Indexes from earlier schemas that the composite indexes above replace:
+# the old single-column model indexes, the old token_schema.sql names and
+# the leaderboard index that did not cover the user_id tiebreak.
+LEGACY_INDEXES = (
+    "ix_token_ledger_user_id",
+    "ix_token_ledger_date",
+    "idx_token_ledger_user_date",
+    "idx_token_achievements_user",
+    "ix_leaderboard_lifetime",
+)
+
+
+def create_schema() -> None:
+    db.create_all()
+    # create_all() skips tables that already exist, so add any indexes
+    # introduced after the database was first created and drop the ones
+    # they superseded.
+    for table in db.metadata.sorted_tables:
+        for index in table.indexes:
+            index.create(db.engine, checkfirst=True)
+    with db.engine.begin() as connection:
+        for name in LEGACY_INDEXES:
+            connection.execute(text(f"DROP INDEX IF EXISTS {name}"))
+    backfill_leaderboard()
+
+
+def backfill_leaderboard() -> None:
+    """Reconcile LeaderboardEntry.lifetime_tokens with the ledger.
+
+    summarize_tokens reads lifetime totals from the leaderboard, which
+    update_leaderboard keeps in step with each ledger insert. Databases
+    written before that was reliable can hold ledger history without a
+    matching leaderboard row, so rebuild the totals from the ledger.
+    """
+    ledger_totals = (
+        db.session.query(
+            TokenLedger.user_id,
+            func.sum(TokenLedger.tokens_earned).label("lifetime_tokens"),
+        )
+        .group_by(TokenLedger.user_id)
+        .subquery()
+    )
+    stale = (
+        db.session.query(ledger_totals, LeaderboardEntry)
+        .outerjoin(LeaderboardEntry, LeaderboardEntry.user_id == ledger_totals.c.user_id)
+        .filter(
+            or_(
+                LeaderboardEntry.id.is_(None),
+                LeaderboardEntry.lifetime_tokens.is_(None),
+                # Running totals and SUM() add in different orders, so
+                # allow float drift below the tokens' 2-decimal precision.
+                func.abs(LeaderboardEntry.lifetime_tokens - ledger_totals.c.lifetime_tokens)
+                > BACKFILL_TOLERANCE,
+            )
+        )
+        .all()
+    )
+    for user_id, lifetime_tokens, entry in stale:
+        if entry is None:
+            entry = LeaderboardEntry(user_id=user_id)
+            db.session.add(entry)
+        entry.lifetime_tokens = lifetime_tokens
+    db.session.commit()
 
 
-def parse_user_id(payload: Dict[str, Any] | None = None) -> str:
-    payload = payload or request.get_json(silent=True) or {}
+def parse_user_id(payload: Dict[str, Any]) -> str:
     user_id = (
         request.headers.get("X-User-Id")
         or request.args.get("user_id")
@@ -66,10 +210,27 @@ def parse_user_id(payload: Dict[str, Any] | None = None) -> str:
     return user_id
 
 
-def validate_savings(carbon_saved_kg: float) -> None:
-    if carbon_saved_kg < 0:
-        raise ValueError("Carbon saved must be positive.")
-    if carbon_saved_kg > MAX_SAVINGS_PER_DAY:
+def validate_savings(entries: List[Tuple[date, float]]) -> None:
+    for _, carbon_saved_kg in entries:
+        if carbon_saved_kg < 0:
+            raise ValueError("Carbon saved must be positive.")
+
+
+def check_daily_cap(user_id: str, days: Set[date]) -> None:
+    """Reject once the user's recorded savings on any of ``days`` exceed the cap.
+
+    Call after the new entries are flushed: the insert holds SQLite's write
+    lock until commit, so the sum sees every report that committed first
+    and no concurrent report can slip in before ours.
+    """
+    over_cap = (
+        db.session.query(TokenLedger.date)
+        .filter(TokenLedger.user_id == user_id, TokenLedger.date.in_(days))
+        .group_by(TokenLedger.date)
+        .having(func.sum(TokenLedger.carbon_saved_kg) > MAX_SAVINGS_PER_DAY)
+        .first()
+    )
+    if over_cap is not None:
         raise ValueError("Reported savings exceed realistic thresholds.")
 
 
@@ -78,91 +239,174 @@ def summarize_tokens(user_id: str) -> Dict[str, Any]:
     week_start = today - timedelta(days=6)
     month_start = today.replace(day=1)
 
-    def aggregate(start: date | None = None) -> float:
-        query = TokenLedger.query.filter_by(user_id=user_id)
-        if start:
-            query = query.filter(TokenLedger.date >= start)
-        return sum(entry.tokens_earned for entry in query.all())
+    def period_sum(start: date, exact: bool = False):
+        matches = TokenLedger.date == start if exact else TokenLedger.date >= start
+        return func.coalesce(
+            func.sum(case((matches, TokenLedger.tokens_earned), else_=0)), 0
+        )
+
+    # One aggregate over the (user_id, date) index range covering the
+    # current week and month, instead of loading every row.
+    month, week, today_total = (
+        db.session.query(
+            period_sum(month_start),
+            period_sum(week_start),
+            period_sum(today, exact=True),
+        )
+        .filter(
+            TokenLedger.user_id == user_id,
+            TokenLedger.date >= min(week_start, month_start),
+        )
+        .one()
+    )
+    # Lifetime is kept incrementally on the leaderboard by update_leaderboard.
+    lifetime = (
+        db.session.query(LeaderboardEntry.lifetime_tokens)
+        .filter_by(user_id=user_id)
+        .scalar()
+    )
 
     return {
-        "today": aggregate(today),
-        "week": aggregate(week_start),
-        "month": aggregate(month_start),
-        "lifetime": aggregate(),
+        "today": float(today_total),
+        "week": float(week),
+        "month": float(month),
+        "lifetime": float(lifetime or 0.0),
     }
 
 
 def update_leaderboard(user_id: str, tokens_delta: float) -> None:
     entry = LeaderboardEntry.query.filter_by(user_id=user_id).first()
     if not entry:
-        entry = LeaderboardEntry(user_id=user_id)
+        entry = LeaderboardEntry(user_id=user_id, lifetime_tokens=0)
         db.session.add(entry)
     entry.lifetime_tokens += tokens_delta
-    db.session.commit()
+    db.session.flush()
 
 
 def check_achievements(user_id: str, lifetime_tokens: float) -> list[str]:
-    badges = [
-        ("green_starter", 100),
-        ("eco_warrior", 1000),
-        ("zero_carbon_hero", 10000),
-    ]
-    unlocked = []
-    existing = {a.badge for a in Achievement.query.filter_by(user_id=user_id)}
-    for badge, threshold in badges:
-        if lifetime_tokens >= threshold and badge not in existing:
-            db.session.add(Achievement(user_id=user_id, badge=badge))
-            unlocked.append(badge)
+    earned = _BADGE_NAMES[:bisect_right(_BADGE_THRESHOLDS, lifetime_tokens)]
+    if not earned:
+        return []
+
+    existing = {
+        badge
+        for (badge,) in db.session.query(Achievement.badge).filter_by(user_id=user_id)
+    }
+    unlocked = [badge for badge in earned if badge not in existing]
     if unlocked:
-        db.session.commit()
+        db.session.bulk_save_objects(
+            [Achievement(user_id=user_id, badge=badge) for badge in unlocked]
+        )
     return unlocked
 
 
-@app.route("/earn-tokens", methods=["POST"])
-def earn_tokens():
-    payload = request.get_json(force=True)
+def _record_tokens(user_id: str, entries: List[Tuple[date, float]]):
+    """Validate and store (date, carbon_saved_kg) entries; returns the endpoint response."""
     try:
-        user_id = parse_user_id(payload)
-        carbon_saved_kg = float(payload.get("carbon_saved_kg", 0))
-        validate_savings(carbon_saved_kg)
-    except (ValueError, TypeError) as exc:
+        validate_savings(entries)
+    except ValueError as exc:
         return jsonify({"success": False, "error": str(exc)}), 400
 
-    tokens = round(carbon_saved_kg * TOKENS_PER_KG, 2)
-    today = date.today()
-
-    ledger_entry = TokenLedger(
-        user_id=user_id,
-        date=today,
-        carbon_saved_kg=carbon_saved_kg,
-        tokens_earned=tokens,
-    )
-    db.session.add(ledger_entry)
-    db.session.commit()
+    mappings = [
+        {
+            "user_id": user_id,
+            "date": entry_date,
+            "carbon_saved_kg": carbon_saved_kg,
+            "tokens_earned": round(carbon_saved_kg * TOKENS_PER_KG, 2),
+        }
+        for entry_date, carbon_saved_kg in entries
+    ]
+    tokens = round(sum(mapping["tokens_earned"] for mapping in mappings), 2)
 
-    update_leaderboard(user_id, tokens)
-    summary = summarize_tokens(user_id)
-    unlocked = check_achievements(user_id, summary["lifetime"])
+    # Ledger, leaderboard and achievements land in a single transaction.
+    try:
+        db.session.bulk_insert_mappings(TokenLedger, mappings)
+        check_daily_cap(user_id, {entry_date for entry_date, _ in entries})
+        update_leaderboard(user_id, tokens)
+        summary = summarize_tokens(user_id)
+        unlocked = check_achievements(user_id, summary["lifetime"])
+        db.session.commit()
+    except ValueError as exc:
+        db.session.rollback()
+        return jsonify({"success": False, "error": str(exc)}), 400
+    except SQLAlchemyError:
+        db.session.rollback()
+        return jsonify({"success": False, "error": "Could not record tokens."}), 500
 
     return jsonify({
         "success": True,
+        "events_recorded": len(entries),
         "tokens_earned": tokens,
-        "carbon_saved_kg": carbon_saved_kg,
+        "carbon_saved_kg": sum(carbon_saved_kg for _, carbon_saved_kg in entries),
         "totals": summary,
         "unlocked": unlocked,
     })
 
 
+@app.route("/earn-tokens", methods=["POST"])
+def earn_tokens():
+    payload = request.get_json(force=True, silent=True)
+    try:
+        if not isinstance(payload, dict):
+            raise ValueError("Request body must be a JSON object.")
+        user_id = parse_user_id(payload)
+        carbon_saved_kg = float(payload.get("carbon_saved_kg", 0))
+    except (ValueError, TypeError) as exc:
+        return jsonify({"success": False, "error": str(exc)}), 400
+
+    return _record_tokens(user_id, [(date.today(), carbon_saved_kg)])
+
+
+@app.route("/earn-tokens/bulk", methods=["POST"])
+def earn_tokens_bulk():
+    """Record a batch of (possibly back-dated) savings in one transaction."""
+    payload = request.get_json(force=True, silent=True)
+    try:
+        if not isinstance(payload, dict):
+            raise ValueError("Request body must be a JSON object.")
+        user_id = parse_user_id(payload)
+        events = payload.get("events")
+        if not isinstance(events, list) or not events:
+            raise ValueError("events must be a non-empty list.")
+        if len(events) > MAX_BULK_EVENTS:
+            raise ValueError(f"At most {MAX_BULK_EVENTS} events per request.")
+
+        today = date.today()
+        earliest = today - timedelta(days=MAX_BACKDATE_DAYS)
+        entries = []
+        for entry in events:
+            if not isinstance(entry, dict):
+                raise ValueError("Each event must be a JSON object.")
+            entry_date = date.fromisoformat(entry["date"]) if entry.get("date") else today
+            if entry_date > today:
+                raise ValueError("Event dates cannot be in the future.")
+            if entry_date < earliest:
+                raise ValueError(
+                    f"Event dates cannot be more than {MAX_BACKDATE_DAYS} days old."
+                )
+            entries.append((entry_date, float(entry.get("carbon_saved_kg", 0))))
+    except (ValueError, TypeError) as exc:
+        return jsonify({"success": False, "error": str(exc)}), 400
+
+    return _record_tokens(user_id, entries)
+
+
 @app.route("/get-tokens", methods=["GET"])
 def get_tokens():
     try:
-        user_id = parse_user_id()
+        user_id = parse_user_id(request.get_json(silent=True) or {})
     except ValueError as exc:
         return jsonify({"success": False, "error": str(exc)}), 400
 
     history = (
-        TokenLedger.query.filter_by(user_id=user_id)
-        .order_by(TokenLedger.created_at.desc())
+        db.session.query(
+            TokenLedger.date,
+            TokenLedger.carbon_saved_kg,
+            TokenLedger.tokens_earned,
+        )
+        .filter_by(user_id=user_id)
+        # CURRENT_TIMESTAMP has one-second resolution; id breaks ties.
+        .order_by(TokenLedger.created_at.desc(), TokenLedger.id.desc())
         .limit(50)
         .all()
     )
@@ -172,39 +416,75 @@ def get_tokens():
         "totals": summary,
         "history": [
             {
-                "date": entry.date.isoformat(),
-                "carbon_saved_kg": entry.carbon_saved_kg,
-                "tokens_earned": entry.tokens_earned,
+                "date": entry_date.isoformat(),
+                "carbon_saved_kg": carbon_saved_kg,
+                "tokens_earned": tokens_earned,
             }
-            for entry in history
+            for entry_date, carbon_saved_kg, tokens_earned in history
         ],
     })
 
 
 @app.route("/leaderboard", methods=["GET"])
 def leaderboard():
-    top_entries = (
-        LeaderboardEntry.query.order_by(LeaderboardEntry.lifetime_tokens.desc())
-        .limit(20)
+    try:
+        limit = int(request.args.get("limit", LEADERBOARD_PAGE_SIZE))
+        if not 1 <= limit <= LEADERBOARD_MAX_PAGE_SIZE:
+            raise ValueError(
+                f"limit must be between 1 and {LEADERBOARD_MAX_PAGE_SIZE}."
+            )
+        after_tokens = request.args.get("after_tokens", type=float)
+        after_user = request.args.get("after_user")
+        if (after_tokens is None) != (after_user is None):
+            raise ValueError("after_tokens and after_user must be given together.")
+    except ValueError as exc:
+        return jsonify({"success": False, "error": str(exc)}), 400
+
+    query = db.session.query(
+        LeaderboardEntry.user_id,
+        LeaderboardEntry.display_name,
+        LeaderboardEntry.lifetime_tokens,
+    )
+    if after_user is not None:
+        # Keyset cursor matching the (lifetime_tokens DESC, user_id ASC) order.
+        query = query.filter(
+            or_(
+                LeaderboardEntry.lifetime_tokens < after_tokens,
+                and_(
+                    LeaderboardEntry.lifetime_tokens == after_tokens,
+                    LeaderboardEntry.user_id > after_user,
+                ),
+            )
+        )
+    rows = (
+        query.order_by(LeaderboardEntry.lifetime_tokens.desc(), LeaderboardEntry.user_id)
+        .limit(limit)
         .all()
     )
+
+    next_cursor = None
+    if len(rows) == limit:
+        last_user, _, last_tokens = rows[-1]
+        next_cursor = {"after_tokens": last_tokens, "after_user": last_user}
+
     return jsonify({
         "success": True,
         "leaders": [
             {
-                "user_id": entry.user_id,
-                "display_name": entry.display_name,
-                "lifetime_tokens": entry.lifetime_tokens,
+                "user_id": user_id,
+                "display_name": display_name,
+                "lifetime_tokens": lifetime_tokens,
             }
-            for entry in top_entries
+            for user_id, display_name, lifetime_tokens in rows
         ],
+        "next_cursor": next_cursor,
     })
 
 
 @app.route("/achievements", methods=["GET"])
 def achievements():
     try:
-        user_id = parse_user_id()
+        user_id = parse_user_id(request.get_json(silent=True) or {})
     except ValueError as exc:
         return jsonify({"success": False, "error": str(exc)}), 400
 
@@ -220,11 +500,11 @@ def achievements():
 
 @app.route("/health", methods=["GET"])
 def health():
-    return jsonify({"status": "ok", "timestamp": datetime.utcnow().isoformat()})
+    return jsonify({"status": "ok", "timestamp": datetime.now(timezone.utc).isoformat()})
 
 
 if __name__ == "__main__":
     with app.app_context():
-        db.create_all()
+        create_schema()
     app.run(debug=True, port=7000)
 
@@ -9,9 +9,12 @@ CREATE TABLE IF NOT EXISTS token_ledger (
     created_at DATETIME DEFAULT CURRENT_TIMESTAMP
 );
 
-CREATE INDEX IF NOT EXISTS idx_token_ledger_user_date
+CREATE INDEX IF NOT EXISTS ix_ledger_user_date
     ON token_ledger (user_id, date);
 
+CREATE INDEX IF NOT EXISTS ix_ledger_user_created
+    ON token_ledger (user_id, created_at);
+
 CREATE TABLE IF NOT EXISTS token_leaderboard (
     id INTEGER PRIMARY KEY AUTOINCREMENT,
     user_id TEXT NOT NULL UNIQUE,
@@ -19,6 +22,9 @@ CREATE TABLE IF NOT EXISTS token_leaderboard (
     lifetime_tokens REAL DEFAULT 0
 );
 
+CREATE INDEX IF NOT EXISTS ix_leaderboard_lifetime_user
+    ON token_leaderboard (lifetime_tokens DESC, user_id);
+
 CREATE TABLE IF NOT EXISTS token_achievements (
     id INTEGER PRIMARY KEY AUTOINCREMENT,
     user_id TEXT NOT NULL,
@@ -26,6 +32,6 @@ CREATE TABLE IF NOT EXISTS token_achievements (
     unlocked_on DATETIME DEFAULT CURRENT_TIMESTAMP
 );
 
-CREATE INDEX IF NOT EXISTS idx_token_achievements_user
+CREATE INDEX IF NOT EXISTS ix_token_achievements_user_id
     ON token_achievements (user_id);
 